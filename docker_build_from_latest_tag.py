@@ -1,52 +1,181 @@
-import datetime
+import concurrent.futures
+import hashlib
+import json
+import os
 import pathlib
 import subprocess
+import tempfile
 import time
 from typing import Optional
 
-from git import Repo, TagReference
-import github
+from git import Repo
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from repos import load_repos
 
-def get_latest_github_tag(access_token: str, repo_name: str) -> Optional[str]:
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Latest tag of a repository. Tags are sorted on commit date with the
+# newest tag first, so only the first one needs to be fetched
+LATEST_TAG_FRAGMENT = """
+fragment LatestTag on Repository {
+  refs(refPrefix: "refs/tags/", first: 1,
+       orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) {
+    nodes {
+      name
+    }
+  }
+}
+"""
+
+DOCKER_AUTH_URL = "https://auth.docker.io/token"
+DOCKER_REGISTRY_URL = "https://registry-1.docker.io/v2"
+
+# Manifest formats accepted when checking if an image exists in the
+# registry (single and multi platform images, Docker and OCI formats)
+DOCKER_MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+
+# Label storing the hash of the build context on images built from local
+# repos
+CONTEXT_HASH_LABEL = "context-sha256"
+
+# Number of lines from the end of the build log to print when a build
+# fails
+BUILD_LOG_TAIL_LINES = 30
+
+
+def create_github_session(access_token: str) -> requests.Session:
     """
-    Get latest tag from a GitHub repository.
+    Create an HTTP session for requests to the GitHub API.
+
+    The session keeps the connection to GitHub alive between requests,
+    and retries requests failing with a temporary server error.
 
     :param access_token: Personal access token for the account where the
-        repository resides.
-    :param repo_name: Name of the repository.
-    :return: Tag name, or None if repo doesn't exist or if it has no
-        tags.
+        repositories reside.
+    :return: Session authenticated with the given access token.
     """
-    # Get GitHub account from access token
-    g = github.Github(access_token)
-    # Get repo with given name
-    try:
-        repo = g.get_repo("{}/{}".format(g.get_user().login, repo_name))
-    except github.GithubException:
-        # Repo doesn't exist
-        return None
-    # Get all tags in the repo
-    tags = repo.get_tags()
-    if tags.totalCount == 0:
-        # No tags in repo
+    session = requests.Session()
+    session.headers["Authorization"] = f"bearer {access_token}"
+    retry = Retry(total=3, backoff_factor=1,
+                  status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
+
+
+def rate_limit_wait_time(response: requests.Response) -> Optional[float]:
+    """
+    Get the time to wait before retrying a request to the GitHub API
+    that may have hit a rate limit.
+
+    :param response: Response from the GitHub API.
+    :return: Number of seconds to wait, or None if the request was not
+        rate limited.
+    """
+    if response.status_code == 200:
+        # The GraphQL API reports exceeded rate limits as query errors
+        errors = response.json().get("errors", [])
+        rate_limited = any(
+            error.get("type") == "RATE_LIMITED" for error in errors)
+    else:
+        rate_limited = response.status_code in (403, 429)
+    if not rate_limited:
         return None
-    # Get latest tag by sorting tags on commit date
+    if "Retry-After" in response.headers:
+        # Secondary rate limit
+        return float(response.headers["Retry-After"])
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        # Primary rate limit, wait until it is reset
+        reset_time = float(response.headers["X-RateLimit-Reset"])
+        return max(reset_time - time.time(), 0.0) + 1.0
+    # Forbidden for some other reason
+    return None
 
-    def commit_date(tag: github.Tag) -> datetime.datetime:
-        """
-        Get date and time when the commit corresponding to a tag was
-        created.
 
-        :param tag: GitHub tag.
-        :return: Date and time when the commit was created.
-        """
-        return datetime.datetime.strptime(
-            repo.get_commit(tag.commit.sha).last_modified,
-            "%a, %d %b %Y %H:%M:%S %Z")
+def post_github_query(session: requests.Session, query: str,
+                      variables: dict) -> requests.Response:
+    """
+    Send a query to the GitHub GraphQL API. If a rate limit has been
+    exceeded, wait until the limit is reset and send the query again.
+
+    :param session: Session authenticated with a personal access token.
+    :param query: GraphQL query.
+    :param variables: Values for the variables in the query.
+    :return: Response to the query.
+    """
+    while True:
+        response = session.post(
+            GITHUB_GRAPHQL_URL,
+            json={"query": query, "variables": variables},
+            timeout=30)
+        wait_time = rate_limit_wait_time(response)
+        if wait_time is None:
+            return response
+        print(f"GitHub rate limit exceeded, retrying in {wait_time:.0f} s")
+        time.sleep(wait_time)
+
+
+def get_latest_github_tags(session: requests.Session, github_login: str,
+                           repo_names: list[str]) -> dict[str, Optional[str]]:
+    """
+    Get latest tag from each of a number of GitHub repositories.
 
-    latest_tag = max(tags, key=commit_date)
-    return latest_tag.name
+    :param session: Session authenticated with a personal access token
+        for the account where the repositories reside.
+    :param github_login: Name of the account where the repositories
+        reside.
+    :param repo_names: Names of the repositories.
+    :return: Tag name for each repository, or None if the repo doesn't
+        exist, if it has no tags or if the request failed.
+    """
+    # Query all repos in a single request, using one aliased field per
+    # repo
+    variable_definitions = "".join(
+        f", $repo{i}: String!" for i in range(len(repo_names)))
+    fields = "".join(
+        f"  repo{i}: repository(owner: $owner, name: $repo{i}) "
+        f"{{ ...LatestTag }}\n" for i in range(len(repo_names)))
+    query = (f"query($owner: String!{variable_definitions}) {{\n"
+             f"{fields}}}\n{LATEST_TAG_FRAGMENT}")
+    variables = {"owner": github_login}
+    for i, repo_name in enumerate(repo_names):
+        variables[f"repo{i}"] = repo_name
+    latest_tags = {repo_name: None for repo_name in repo_names}
+    try:
+        response = post_github_query(session, query, variables)
+    except requests.RequestException as error:
+        # Includes running out of retries on server errors
+        print(f"GitHub request failed. error: {error}")
+        return latest_tags
+    if response.status_code != 200:
+        print(f"GitHub request failed. status: {response.status_code}, "
+              f"response: {response.text}")
+        return latest_tags
+    result = response.json()
+    errors = [error for error in result.get("errors", [])
+              if error.get("type") != "NOT_FOUND"]
+    if errors:
+        print(f"GitHub query failed. errors: {errors}")
+    data = result.get("data") or {}
+    for i, repo_name in enumerate(repo_names):
+        repository = data.get(f"repo{i}")
+        if repository is None:
+            # Repo doesn't exist
+            continue
+        tags = repository["refs"]["nodes"]
+        if len(tags) == 0:
+            # No tags in repo
+            continue
+        latest_tags[repo_name] = tags[0]["name"]
+    return latest_tags
 
 
 def get_latest_local_tag(repo_name: str) -> Optional[str]:
@@ -60,66 +189,188 @@ def get_latest_local_tag(repo_name: str) -> Optional[str]:
     repo_path = pathlib.Path(__file__).resolve().parent.parent / repo_name
     git_repo = Repo(repo_path)
 
-    # Get all tags in the repo
-    tags = git_repo.tags
-    if len(tags) == 0:
+    # List all tags in the repo with their commit date (seconds since
+    # epoch) using a single git command. The date of the tagged commit is
+    # given by '*committerdate' for annotated tags and by 'committerdate'
+    # for lightweight tags, the other field is empty
+    tag_list = git_repo.git.for_each_ref(
+        "refs/tags",
+        format="%(*committerdate:unix)%(committerdate:unix) "
+               "%(refname:lstrip=2)")
+    if not tag_list:
         # No tags in repo
         return None
     # Get latest tag by sorting tags on commit date
+    latest_tag = max(
+        (line.partition(" ") for line in tag_list.splitlines()),
+        key=lambda tag: int(tag[0] or 0))
+    return latest_tag[2]
 
-    def commit_date(tag: TagReference) -> datetime.datetime:
-        """
-        Get date and time when the commit corresponding to a tag was
-        created.
 
-        :param tag: Git tag.
-        :return: Date and time when the commit was created.
-        """
-        return datetime.datetime.fromtimestamp(
-            time.mktime(time.gmtime(tag.commit.committed_date)))
+def run_docker_build(build_command: list[str], docker_image: str) -> bool:
+    """
+    Run a Docker build command, writing the build log to a file.
 
-    latest_tag = max(tags, key=commit_date)
-    return latest_tag
+    :param build_command: Build command to run.
+    :param docker_image: Name of the image being built, used to name the
+        log file.
+    :return: Whether the build was successful.
+    """
+    # Write the build log to a file per image instead of keeping it in
+    # memory, since several images are built in parallel
+    log_path = (pathlib.Path(tempfile.gettempdir()) /
+                f"docker-build-{docker_image}.log")
+    with open(log_path, "w") as log_file:
+        result = subprocess.run(build_command, stdout=subprocess.DEVNULL,
+                                stderr=log_file)
+    if result.returncode != 0:
+        # The end of the log holds the output from the failing step
+        log_lines = log_path.read_text(errors="replace").splitlines()
+        log_tail = "\n".join(log_lines[-BUILD_LOG_TAIL_LINES:])
+        print(f"docker build failed. Full log in {log_path}, last lines:\n"
+              f"{log_tail}")
+        return False
+    return True
 
 
 def build_image_from_github_tag(github_login: str, repo_name: str, tag: str,
-                         docker_login: str) -> Optional[str]:
+                                docker_login: str,
+                                push: bool = False) -> Optional[str]:
     """
     Build a Docker image from a tag in a GitHub repository.
 
+    The 'latest' image on Docker hub is used as build cache, and the
+    cache metadata is stored inline in the new image so that the next
+    build can use it in turn.
+
     :param github_login: Name of the account where the GitHub repository
         resides.
     :param repo_name: Name of the repository.
     :param tag: Name of the tag to build from.
     :param docker_login: Name of the Docker hub account the image should
         be pushed to.
-    :return: Return tag for the new image, or None if the build failed.
+    :param push: Whether to push the built image to Docker hub. Requires
+        that the user is logged in to the Docker hub account.
+    :return: Return tag for the new image, or None if the build (or
+        push) failed. The image is also tagged as 'latest'.
     """
-    assert repo_name[0:7] == "docker-"
-    docker_image = repo_name[7:]
+    assert repo_name.startswith("docker-")
+    docker_image = repo_name[len("docker-"):]
     docker_tag = f"{docker_login}/{docker_image}:{tag}"
+    # Also use new image as the new 'latest' version
+    latest_tag = f"{docker_login}/{docker_image}:latest"
     repo_url = "https://github.com/{}/{}.git".format(github_login, repo_name)
     repo_url_with_tag = repo_url + "#{}".format(tag)
     build_command = [
         "docker",
+        "buildx",
         "build",
+        "--progress=plain",
+        "--cache-from",
+        f"type=registry,ref={latest_tag}",
+        "--cache-to",
+        "type=inline",
         "--tag",
         docker_tag,
+        "--tag",
+        latest_tag,
+        "--push" if push else "--load",
         repo_url_with_tag
     ]
     print("    Build command: " + " ".join(build_command))
-    result = subprocess.run(build_command, capture_output=True)
-    if result.returncode != 0:
-        print(f"docker build failed. stdout: {result.stdout}, stderr: "
-              f"{result.stderr}")
+    if not run_docker_build(build_command, docker_image):
         return None
     print(f"Docker image {docker_tag} built from GitHub repo {repo_name}, "
           f"tag {tag}")
+    if push:
+        print(f"Docker image {docker_tag} pushed to Docker hub.")
     return docker_tag
 
 
-def build_image_from_local_tag(repo_name: str, tag: str,
-                               docker_login: str) -> Optional[str]:
+def hash_build_context(path: pathlib.Path,
+                       parent_image_id: Optional[str] = None) -> str:
+    """
+    Compute a hash of the contents of a Docker build context.
+
+    :param path: Root folder of the build context. Any '.git' folder is
+        ignored.
+    :param parent_image_id: ID of the image the Dockerfile in the build
+        context is built from, if it is built locally. Included in the
+        hash, so that the hash changes when the parent image is rebuilt.
+    :return: Hexadecimal SHA-256 hash of the paths and contents of all
+        files in the build context.
+    """
+    context_hash = hashlib.sha256()
+    if parent_image_id is not None:
+        context_hash.update(parent_image_id.encode() + b"\0")
+    for root, dirs, files in os.walk(path):
+        # Walk folders in sorted order to get a deterministic hash
+        dirs[:] = sorted(d for d in dirs if d != ".git")
+        # Links to folders are listed among the folders, but not walked
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        for file_name in sorted(files + links):
+            file_path = pathlib.Path(root) / file_name
+            context_hash.update(
+                file_path.relative_to(path).as_posix().encode() + b"\0")
+            if file_path.is_symlink():
+                # Docker copies links as they are, so hash the link
+                # target (which may not exist)
+                content = b"link\0" + os.readlink(file_path).encode()
+            else:
+                content = file_path.read_bytes()
+            context_hash.update(hashlib.sha256(content).digest())
+    return context_hash.hexdigest()
+
+
+def get_local_image_id(image: str) -> Optional[str]:
+    """
+    Get the ID of a local Docker image.
+
+    :param image: Specification of the image on the form 'NAME:TAG'.
+    :return: ID of the image, or None if the image doesn't exist.
+    """
+    inspect_command = [
+        "docker",
+        "image",
+        "inspect",
+        "--format",
+        "{{ .Id }}",
+        image
+    ]
+    result = subprocess.run(inspect_command, capture_output=True, text=True)
+    if result.returncode != 0:
+        # Image doesn't exist
+        return None
+    return result.stdout.strip()
+
+
+def get_local_image_label(image: str, label: str) -> Optional[str]:
+    """
+    Get the value of a label on a local Docker image.
+
+    :param image: Specification of the image on the form 'NAME:TAG'.
+    :param label: Name of the label.
+    :return: Value of the label, or None if the image doesn't exist or
+        doesn't have the label.
+    """
+    inspect_command = [
+        "docker",
+        "image",
+        "inspect",
+        "--format",
+        f'{{{{ json (index .Config.Labels "{label}") }}}}',
+        image
+    ]
+    result = subprocess.run(inspect_command, capture_output=True, text=True)
+    if result.returncode != 0:
+        # Image doesn't exist
+        return None
+    return json.loads(result.stdout)
+
+
+def build_image_from_local_tag(
+        repo_name: str, tag: str, docker_login: str,
+        parent_image: Optional[str] = None) -> Optional[str]:
     """
     Build a Docker image from a tag in a local repository.
 
@@ -127,107 +378,122 @@ def build_image_from_local_tag(repo_name: str, tag: str,
     :param tag: Name of the tag to build from.
     :param docker_login: Name of the Docker hub account the image should
         be pushed to.
+    :param parent_image: Specification of the locally built image the
+        image is built from, on the form 'NAME:TAG', if any.
     :return: Return tag for the new image, or None if the build failed.
     """
-    assert repo_name[0:7] == "docker-"
-    docker_image = repo_name[7:]
+    assert repo_name.startswith("docker-")
+    docker_image = repo_name[len("docker-"):]
     docker_tag = f"{docker_login}/{docker_image}:{tag}"
+    latest_tag = f"{docker_login}/{docker_image}:latest"
     repo_path = pathlib.Path(__file__).resolve().parent.parent / repo_name
+    # Skip the build if the image has already been built from the same
+    # build context and parent image
+    parent_image_id = (None if parent_image is None
+                       else get_local_image_id(parent_image))
+    context_hash = hash_build_context(repo_path, parent_image_id)
+    if get_local_image_label(docker_tag, CONTEXT_HASH_LABEL) == context_hash:
+        print(f"Docker image {docker_tag} already built from {repo_name}, "
+              f"tag {tag}")
+        return docker_tag
+    # Use the 'latest' image on Docker hub as build cache
     build_command = [
         "docker",
+        "buildx",
         "build",
+        "--progress=plain",
+        "--cache-from",
+        f"type=registry,ref={latest_tag}",
+        "--label",
+        f"{CONTEXT_HASH_LABEL}={context_hash}",
+        "--load",
         "--tag",
         docker_tag,
         str(repo_path)
     ]
     print("    Build command: " + " ".join(build_command))
-    result = subprocess.run(build_command, capture_output=True)
-    if result.returncode != 0:
-        print(f"docker build failed. stdout: {result.stdout}, stderr: "
-              f"{result.stderr}")
+    if not run_docker_build(build_command, docker_image):
         return None
     print(f"Docker image {docker_tag} built from {repo_name}, tag {tag}")
     return docker_tag
 
 
-def push_image_to_dockerhub(access_token: str, tag: str) -> bool:
+def image_exists_on_dockerhub(username: str, image: str, tag: str,
+                              access_token: Optional[str] = None) -> bool:
     """
-    Push a Docker image to Docker hub.
+    Check whether an image with a given tag has been pushed to Docker hub.
 
-    :param access_token: Personal access token to the Docker hub account
-        the image should be pushed to.
-    :param tag: Specification of the image that should be pushed on the
-        form 'NAME:TAG'.
-    :return: Whether the push was successful.
+    :param username: Name of the Docker hub account the image belongs to.
+    :param image: Name of the image.
+    :param tag: Tag of the image.
+    :param access_token: Personal access token to the Docker hub account.
+        Needed to check private images.
+    :return: Whether the image exists. False if the registry could not
+        be accessed.
+    """
+    auth = (username, access_token) if access_token else None
+    try:
+        # Get a registry token with pull access to the image repository
+        response = requests.get(
+            DOCKER_AUTH_URL,
+            params={
+                "service": "registry.docker.io",
+                "scope": f"repository:{username}/{image}:pull"
+            },
+            auth=auth,
+            timeout=30)
+        if response.status_code != 200:
+            return False
+        registry_token = response.json()["token"]
+        # Check for the manifest of the tag, without downloading it
+        response = requests.head(
+            f"{DOCKER_REGISTRY_URL}/{username}/{image}/manifests/{tag}",
+            headers={
+                "Authorization": f"Bearer {registry_token}",
+                "Accept": ", ".join(DOCKER_MANIFEST_TYPES)
+            },
+            timeout=30)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def login_to_dockerhub(username: str, access_token: str) -> bool:
+    """
+    Log in to Docker hub.
+
+    The credentials are stored by Docker, so this only needs to be done
+    once before pushing any number of images.
+
+    :param username: Name of the Docker hub account.
+    :param access_token: Personal access token to the Docker hub account.
+    :return: Whether the login was successful.
     """
-    print("    Docker push")
-    username_end = tag.find("/")
-    assert username_end != -1
-    username = tag[0:username_end]
     login_command = [
         "docker",
         "login",
         "--username",
         username,
-        "--password",
-        access_token
-    ]
-    print(f"    Login command: `{' '.join(login_command[:-1] + ['****'])}`")
-    result = subprocess.run(login_command, capture_output=True)
-    if result.returncode != 0:
-        print(f"docker login failed. stdout: {result.stdout}, stderr: "
-              f"{result.stderr}")
-        return False
-    push_command = [
-        "docker",
-        "push",
-        tag
-    ]
-    print(f"    Push command: `{' '.join(push_command)}`")
-    result = subprocess.run(push_command, capture_output=True)
-    if result.returncode != 0:
-        print(f"docker push failed. stdout: {result.stdout}, stderr: "
-              f"{result.stderr}")
-        return False
-    # Also use new image as the new 'latest' version
-    image_name_end = tag.find(":")
-    assert image_name_end != -1
-    image_name = tag[username_end + 1:image_name_end]
-    latest_tag = f"{username}/{image_name}:latest"
-    tag_command = [
-        "docker",
-        "tag",
-        tag,
-        latest_tag
+        "--password-stdin"
     ]
-    print(f"    Tag command: `{' '.join(tag_command)}`")
-    result = subprocess.run(tag_command, capture_output=True)
+    print(f"Login command: `{' '.join(login_command)}`")
+    result = subprocess.run(login_command, input=access_token,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
     if result.returncode != 0:
-        print(f"docker tag failed. stdout: {result.stdout}, stderr: "
-              f"{result.stderr}")
+        print(f"docker login failed. stderr: {result.stderr}")
         return False
-    push_command = [
-        "docker",
-        "push",
-        latest_tag
-    ]
-    print("    Push command: " + " ".join(push_command))
-    result = subprocess.run(push_command, capture_output=True)
-    if result.returncode != 0:
-        print(f"docker push latest failed. stdout: {result.stdout}, "
-              f"stderr: {result.stderr}")
-        return False
-    print(f"Docker image {tag} pushed to Docker hub.")
     return True
 
 
 def build_and_push_github_tag(
         github_login: str, github_repo_name: str, github_repo_tag: str,
-        docker_login: str, docker_access_token: Optional[str]) -> bool:
+        docker_login: str, push: bool) -> bool:
     """
     Build a Docker image from the Dockerfile in the root of a GitHub
     repository. The version of the repository corresponding to the
-    given tag is used. The image is then pushed to Docker hub.
+    given tag is used. The image is optionally pushed to Docker hub as
+    part of the build.
 
     :param github_login: Name of the account where the GitHub repository
         resides.
@@ -236,66 +502,159 @@ def build_and_push_github_tag(
         to use.
     :param docker_login: Name of the Docker hub account the image should
         be pushed to.
-    :param docker_access_token: Personal access token to the Docker hub
-        account the image should be pushed to. Will not push the built
-        image to Docker hub if not provided.
+    :param push: Whether to push the built image to Docker hub. Requires
+        that the user is logged in to the Docker hub account.
     :return: Whether the image was successfully built and optionally
         pushed to Docker hub.
     """
     image_tag = build_image_from_github_tag(
-        github_login, github_repo_name, github_repo_tag, docker_login)
-    if image_tag is None:
-        return False
-    if docker_access_token:
-        return push_image_to_dockerhub(docker_access_token, image_tag)
-    return True
+        github_login, github_repo_name, github_repo_tag, docker_login, push)
+    return image_tag is not None
+
+
+def get_build_stages(repos: list[dict]) -> list[list[str]]:
+    """
+    Group repos into stages, so that the image in each repo is only built
+    from images in earlier stages.
+
+    :param repos: Repos as given by :func:`repos.load_repos`.
+    :return: Names of the repos in each stage.
+    """
+    parents = {repo["name"]: repo.get("parent") for repo in repos}
+
+    def depth(repo_name: str) -> int:
+        """
+        Get number of repos the image in a repo is built on top of.
+
+        :param repo_name: Name of the repository.
+        :return: Number of ancestors of the repo.
+        """
+        parent = parents[repo_name]
+        return 0 if parent is None else depth(parent) + 1
+
+    repo_stages = []
+    for repo in repos:
+        stage = depth(repo["name"])
+        while len(repo_stages) <= stage:
+            repo_stages.append([])
+        repo_stages[stage].append(repo["name"])
+    return repo_stages
+
+
+def _process_repo(
+        repo: str, latest_tag: str, from_github: bool, github_login: str,
+        docker_login: str, docker_access_token: Optional[str],
+        parent_image: Optional[str] = None) -> tuple[str, bool]:
+    """
+    Build and optionally push the Docker image for the latest tag in a
+    repository.
+
+    :param repo: Name of the repository.
+    :param latest_tag: Latest tag in the repository.
+    :param from_github: Whether to build from the tag in GitHub.
+        Otherwise build from the local tag.
+    :param github_login: Name of the account where the GitHub repository
+        resides.
+    :param docker_login: Name of the Docker hub account the image should
+        be pushed to.
+    :param docker_access_token: Personal access token to the Docker hub
+        account. Will push the image built from the latest GitHub tag to
+        Docker hub if provided, unless it has been pushed already.
+        Requires that the user is logged in to the Docker hub account.
+    :param parent_image: Specification of the image the image in the
+        repository is built from, on the form 'NAME:TAG', if it is built
+        from another of the repositories. Only used when building from
+        the local tag.
+    :return: Name of the repository and whether the image was
+        successfully built and optionally pushed to Docker hub.
+    """
+    print(f"In repo {repo}")
+    if from_github:
+        push = bool(docker_access_token)
+        docker_image = repo[len("docker-"):]
+        if push and image_exists_on_dockerhub(
+                docker_login, docker_image, latest_tag, docker_access_token):
+            print(f"Image for tag {latest_tag} in repo {repo} already on "
+                  f"Docker hub")
+            return repo, True
+        if not build_and_push_github_tag(
+                github_login, repo, latest_tag, docker_login, push):
+            print(f"Failed to build and push image for repo {repo}")
+            return repo, False
+    else:
+        if not build_image_from_local_tag(
+                repo, latest_tag, docker_login, parent_image):
+            print(f"Failed to build image for repo {repo}")
+            return repo, False
+    return repo, True
 
 
 def update_fa_repos(
         github_access_token: Optional[str] = None,
-        docker_access_token: Optional[str] = None):
+        docker_access_token: Optional[str] = None,
+        max_workers: int = 4):
     """
     Build and optionally push Docker images for my private GitHub repos.
 
+    Images in the same stage are built in parallel. Each stage only
+    depends on images from earlier stages, so a stage is not started
+    until the previous one has finished.
+
     :param github_access_token: Personal access token to the
         'FAndersson' account. Will build from latest tag in GitHub if
         provided. Otherwise build from latest local tag.
     :param docker_access_token: Personal access token to the
         'fredrikandersson' account. Will push the built image to Docker
         hub if provided.
+    :param max_workers: Maximum number of images to build and push
+        concurrently.
     """
     github_login = "FAndersson"
     docker_login = "fredrikandersson"
-    repos = [
-        "docker-debian-stable-dev-image-base",
-        "docker-debian-stable-cpp-image-base",
-        "docker-debian-stable-cpp-image-clang",
-        "docker-debian-stable-cpp-image-gcc",
-        "docker-debian-stable-latex-image",
-        "docker-debian-stable-python-image",
-        "docker-debian-testing-dev-image-base",
-        "docker-debian-testing-cpp-image-base",
-        "docker-debian-testing-cpp-image-clang",
-        "docker-debian-testing-cpp-image-gcc",
-        "docker-debian-testing-python-image",
-    ]
-    for repo in repos:
-        print(f"In repo {repo}")
-        if github_access_token:
-            latest_tag = get_latest_github_tag(github_access_token, repo)
-        else:
-            latest_tag = get_latest_local_tag(repo)
-        if latest_tag is None:
-            print(f"Failed to get latest tag in repo {repo}")
-            return
-        if github_access_token:
-            if not build_and_push_github_tag(
-                github_login, repo, latest_tag, docker_login,
-                docker_access_token):
-                print(f"Failed to build and push image for repo {repo}")
-        else:
-            if not build_image_from_local_tag(repo, latest_tag, docker_login):
-                print(f"Failed to build image for repo {repo}")
+    repo_list = load_repos()
+    parents = {repo["name"]: repo.get("parent") for repo in repo_list}
+    repo_stages = get_build_stages(repo_list)
+    all_repos = [repo for repos in repo_stages for repo in repos]
+    if github_access_token:
+        # Get the latest tag of all repos in a single request
+        github_session = create_github_session(github_access_token)
+        latest_tags = get_latest_github_tags(
+            github_session, github_login, all_repos)
+    else:
+        latest_tags = {
+            repo: get_latest_local_tag(repo) for repo in all_repos}
+    # Log in to Docker hub once, before pushing any of the images
+    if not github_access_token:
+        # Images built from local tags are never pushed
+        docker_access_token = None
+    if docker_access_token and not login_to_dockerhub(
+            docker_login, docker_access_token):
+        print("Failed to log in to Docker hub")
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        for repos in repo_stages:
+            futures = []
+            for repo in repos:
+                if latest_tags[repo] is None:
+                    print(f"Failed to get latest tag in repo {repo}")
+                    continue
+                parent = parents[repo]
+                parent_image = None
+                if parent is not None and latest_tags[parent] is not None:
+                    # Image built from the latest tag in the parent repo,
+                    # in an earlier stage
+                    parent_image = (f"{docker_login}/"
+                                    f"{parent[len('docker-'):]}:"
+                                    f"{latest_tags[parent]}")
+                futures.append(executor.submit(
+                    _process_repo, repo, latest_tags[repo],
+                    bool(github_access_token), github_login, docker_login,
+                    docker_access_token, parent_image))
+            for future in concurrent.futures.as_completed(futures):
+                repo, success = future.result()
+                status = "done" if success else "failed"
+                print(f"Repo {repo}: {status}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+import json
+import pathlib
+
+REPOS_FILE = pathlib.Path(__file__).resolve().parent / "repos.json"
+
+
+def load_repos(path: pathlib.Path = REPOS_FILE) -> list[dict]:
+    """
+    Load the list of private Docker repos to manage.
+
+    :param path: Path to the JSON file listing the repos.
+    :return: List with a dictionary for each repo, containing the name of
+        the repo ('name'), a description of the image the repo is built
+        from ('base') and, if that image is built from another of the
+        repos, the name of that repo ('parent').
+    """
+    with open(path) as file:
+        return json.load(file)
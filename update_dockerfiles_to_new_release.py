@@ -1,151 +1,157 @@
+import concurrent.futures
+import io
+import os
 import pathlib
 import re
+import shutil
 from typing import Optional
 
-from git import Actor, Repo, TagReference
+from git import Actor, BaseIndexEntry, Repo
+from gitdb import IStream
 
+from repos import load_repos
 
-def get_tag(repo: Repo, tag_name: str) -> Optional[TagReference]:
+# Dates referring to a Debian release, on the forms '20211011' ('date')
+# and '2021-10-11' ('iso_date')
+DATE_PATTERN = re.compile(
+    rb"(?P<date>[0-9]{8})|(?P<iso_date>[0-9]{4}-[0-9]{2}-[0-9]{2})")
+
+# Author (and committer) of the commits made to the repos
+_AUTHOR = Actor("Fredrik Andersson",
+                "fredrik.andersson@industrialpathsolutions.com")
+
+
+def _process_repo(repo: str, base_image: str, folder: pathlib.Path,
+                  tag_date: str, tag_date_iso: str, push: bool) -> str:
     """
-    Get a tag from a repository.
+    Update a private Docker repo to be based on a new version of Debian.
 
-    :param repo: Repository to get tag from.
-    :param tag_name: Name of the tag.
-    :return: Tag with given name, or None if no such tag exists.
+    :param repo: Name of the repository.
+    :param base_image: Description of the image the repo is built from.
+    :param folder: Absolute path to the folder where the Docker repo is
+        located.
+    :param tag_date: Date for the new Debian Docker release, on the form
+        '20211011'.
+    :param tag_date_iso: Date for the new Debian Docker release, on the
+        form '2021-10-11'.
+    :param push: Whether to push changes to GitHub.
+    :return: Name of the repository.
     """
-    for tag in repo.tags:
-        if tag.name == tag_name:
-            return tag
-    return None
+    # New date for each of the date forms matched by DATE_PATTERN
+    new_dates = {"date": tag_date.encode(), "iso_date": tag_date_iso.encode()}
+    print(f"In repo {repo}")
+    repo_path = folder / repo
+    print(f"    {repo}: Updating Dockerfile")
+    # Update Dockerfile in repo, replacing old tag references with new tag
+    dockerfile = repo_path / "Dockerfile"
+    old_content = dockerfile.read_bytes()
+    content = DATE_PATTERN.sub(
+        lambda match: new_dates[match.lastgroup], old_content)
+    if content != old_content:
+        # Write to a temporary file which then replaces the Dockerfile, so
+        # that the Dockerfile is never left partially written
+        temporary_file = dockerfile.with_name("Dockerfile.tmp")
+        temporary_file.write_bytes(content)
+        shutil.copymode(dockerfile, temporary_file)
+        os.replace(temporary_file, dockerfile)
+
+    # Commit changes to Dockerfile (if any)
+    print(f"    {repo}: Committing changes")
+    git_repo = Repo(repo_path)
+    # Look up everything needed from the repo once
+    origin = git_repo.remotes.origin
+    head_tree = git_repo.head.commit.tree
+    tags = {tag.name: tag for tag in git_repo.tags}
+    # Compare with the committed Dockerfile in-process, instead of
+    # running git diff
+    committed_dockerfile = head_tree["Dockerfile"]
+    committed_content = committed_dockerfile.data_stream.read()
+    head_commit = git_repo.head.commit
+    tag = tags.get(tag_date_iso)
+    up_to_date = (content == committed_content and tag is not None and
+                  tag.commit == head_commit)
+    if up_to_date and push:
+        # Also check that origin already has the branch and the tag, using
+        # a single request
+        branch_ref = git_repo.head.ref.path
+        tag_ref = f"refs/tags/{tag_date_iso}"
+        remote_refs = {
+            ref: hexsha for hexsha, ref in (
+                line.split("\t") for line in git_repo.git.ls_remote(
+                    "origin", branch_ref, tag_ref).splitlines())}
+        up_to_date = (remote_refs.get(branch_ref) == head_commit.hexsha and
+                      remote_refs.get(tag_ref) == tag.object.hexsha)
+    if up_to_date:
+        # Nothing to commit, tag or push
+        print(f"    {repo}: Up to date")
+        return repo
+    if content != committed_content:
+        # Write the new content to the object database and stage it
+        # directly, instead of letting the index read the file again
+        blob = git_repo.odb.store(
+            IStream("blob", len(content), io.BytesIO(content)))
+        index = git_repo.index
+        index.add([BaseIndexEntry(
+            (committed_dockerfile.mode, blob.binsha, 0, "Dockerfile"))])
+        commit_message = (f"Build from {tag_date_iso} version of "
+                          f"{base_image}.")
+        index.commit(commit_message, author=_AUTHOR, committer=_AUTHOR)
+
+    # Tag latest commit, replacing any existing tag (also replaced on
+    # GitHub when pushing)
+    if tag_date_iso in tags:
+        print(f"    {repo}: Replacing existing tag")
+    else:
+        print(f"    {repo}: Tagging commit")
+    tag_message = f"From {tag_date_iso} version of {base_image}."
+    git_repo.create_tag(tag_date_iso, message=tag_message, force=True)
+
+    if push:
+        # Push changes and the new tag to origin in a single push. The
+        # push is forced, so any existing tag on GitHub is replaced
+        print(f"    {repo}: Pushing changes to GitHub")
+        origin.push(
+            ["HEAD", f"refs/tags/{tag_date_iso}"], force=True, atomic=True)
+    return repo
 
 
 def update_fa_repos(tag_date: str, folder: pathlib.Path = pathlib.Path(".."),
-                    push: bool = False):
+                    push: bool = False, max_workers: Optional[int] = None):
     """
     Update private Docker repos to be based on a new version of Debian.
 
+    The repos are independent of each other and are updated in parallel.
+
     :param tag_date: Date for the new Debian Docker release, on the form
         '20211011'.
     :param folder: Folder where the Docker repos are located. Absolute
         or relative to this folder.
     :param push: Whether to push changes to GitHub.
+    :param max_workers: Maximum number of repos to update concurrently.
+        Defaults to four per CPU, but not more than the number of repos.
     """
-    repos = [
-        "docker-debian-stable-dev-image-base",
-        "docker-debian-stable-cpp-image-base",
-        "docker-debian-stable-cpp-image-clang",
-        "docker-debian-stable-cpp-image-gcc",
-        "docker-debian-stable-latex-image",
-        "docker-debian-stable-python-image",
-        "docker-debian-testing-dev-image-base",
-        "docker-debian-testing-cpp-image-base",
-        "docker-debian-testing-cpp-image-clang",
-        "docker-debian-testing-cpp-image-gcc",
-        "docker-debian-testing-python-image",
-    ]
+    # Check the date before any repo is modified
+    if not re.fullmatch("[0-9]{8}", tag_date):
+        raise ValueError(f"Invalid tag date '{tag_date}', expected a date "
+                         f"on the form '20211011'")
     tag_date_iso = f"{tag_date[0:4]}-{tag_date[4:6]}-{tag_date[6:8]}"
-    commit_messages = {
-        "docker-debian-stable-dev-image-base":
-            f"Build from {tag_date_iso} version of Debian stable.",
-        "docker-debian-stable-cpp-image-base":
-            f"Build from {tag_date_iso} version of base dev image.",
-        "docker-debian-stable-cpp-image-clang":
-            f"Build from {tag_date_iso} version of base cpp image.",
-        "docker-debian-stable-cpp-image-gcc":
-            f"Build from {tag_date_iso} version of base cpp image.",
-        "docker-debian-stable-latex-image":
-            f"Build from {tag_date_iso} version of base dev image.",
-        "docker-debian-stable-python-image":
-            f"Build from {tag_date_iso} version of base dev image.",
-        "docker-debian-testing-dev-image-base":
-            f"Build from {tag_date_iso} version of Debian testing.",
-        "docker-debian-testing-cpp-image-base":
-            f"Build from {tag_date_iso} version of base dev image.",
-        "docker-debian-testing-cpp-image-clang":
-            f"Build from {tag_date_iso} version of base cpp image.",
-        "docker-debian-testing-cpp-image-gcc":
-            f"Build from {tag_date_iso} version of base cpp image.",
-        "docker-debian-testing-python-image":
-            f"Build from {tag_date_iso} version of base dev image.",
-    }
-    tag_messages = {
-        "docker-debian-stable-dev-image-base":
-            f"From {tag_date_iso} version of Debian stable.",
-        "docker-debian-stable-cpp-image-base":
-            f"From {tag_date_iso} version of base dev image.",
-        "docker-debian-stable-cpp-image-clang":
-            f"From {tag_date_iso} version of base cpp image.",
-        "docker-debian-stable-cpp-image-gcc":
-            f"From {tag_date_iso} version of base cpp image.",
-        "docker-debian-stable-latex-image":
-            f"From {tag_date_iso} version of base dev image.",
-        "docker-debian-stable-python-image":
-            f"From {tag_date_iso} version of base dev image.",
-        "docker-debian-testing-dev-image-base":
-            f"From {tag_date_iso} version of Debian testing.",
-        "docker-debian-testing-cpp-image-base":
-            f"From {tag_date_iso} version of base dev image.",
-        "docker-debian-testing-cpp-image-clang":
-            f"From {tag_date_iso} version of base cpp image.",
-        "docker-debian-testing-cpp-image-gcc":
-            f"From {tag_date_iso} version of base cpp image.",
-        "docker-debian-testing-python-image":
-            f"From {tag_date_iso} version of base dev image.",
-    }
-    if not folder.absolute():
+    if not folder.is_absolute():
         folder = pathlib.Path(__file__).resolve().parent / folder
-    for repo in repos:
-        print(f"In repo {repo}")
-        repo_path = folder / pathlib.Path(repo)
-        print(f"    Updating Dockerfile")
-        # Update Dockerfile in repo, replacing old tag references with new tag
-        with open(repo_path / "Dockerfile") as file:
-            content = file.read()
-        match = re.search("[0-9]{8}", content)
-        offset = 0
-        while match:
-            content = (content[0:match.start() + offset]
-                       + tag_date
-                       + content[match.end() + offset:])
-            offset += match.end()
-            match = re.search("[0-9]{8}", content[offset:])
-        match = re.search("[0-9]{4}-[0-9]{2}-[0-9]{2}", content)
-        offset = 0
-        while match:
-            content = (content[0:match.start() + offset]
-                       + tag_date_iso
-                       + content[match.end() + offset:])
-            offset += match.end()
-            match = re.search("[0-9]{4}-[0-9]{2}-[0-9]{2}", content[offset:])
-        with open(repo_path / "Dockerfile", 'w', newline='\n') as file:
-            file.write(content)
-
-        # Commit changes to Dockerfile (if any)
-        print("    Committing changes")
-        git_repo = Repo(repo_path)
-        diff = git_repo.git.diff(git_repo.head.commit.tree)
-        if diff:
-            index = git_repo.index
-            index.add([str((repo_path / "Dockerfile").resolve())])
-            author = Actor("Fredrik Andersson", "fredrik.andersson@industrialpathsolutions.com")
-            index.commit(commit_messages[repo], author=author, committer=author)
-
-        # Remove any existing tag
-        tag = get_tag(git_repo, tag_date_iso)
-        if tag:
-            print("    Removing existing tag")
-            git_repo.delete_tag(tag)
-            git_repo.remotes.origin.push(refspec=f":refs/tags/{tag_date_iso}")
-
-        # Tag latest commit
-        print("    Tagging commit")
-        new_tag = git_repo.create_tag(tag_date_iso, message=tag_messages[repo])
-
-        if push:
-            # Push changes to origin
-            print("    Pushing changes to GitHub")
-            git_repo.remotes.origin.push(force=True)
-            git_repo.remotes.origin.push(new_tag)
+    folder = folder.resolve()
+    repos = load_repos()
+    if max_workers is None:
+        max_workers = min(len(repos), (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _process_repo, repo["name"], repo["base"], folder, tag_date,
+                tag_date_iso, push)
+            for repo in repos
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            repo = future.result()
+            print(f"Repo {repo}: done")
 
 
 if __name__ == "__main__":